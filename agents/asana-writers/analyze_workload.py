@@ -1,88 +1,127 @@
-import os, json, datetime as dt, time
-import gspread
-from google.oauth2.service_account import Credentials
-from openai import OpenAI
+from __future__ import annotations
+import os, functools, logging, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+import orjson
+
+# gspread/google-auth (via sheets_client) and openai are heavy imports; they
+# are pulled in by the helpers that need them so importing this module stays cheap.
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+from hub_parents import INCLUDE_HUB_PARENTS, is_hub_parent
+from sheets_client import open_spreadsheet, open_tab
 
 SHEET_ID = os.getenv("ASANA_GOOGLE_SHEET_ID")
 SHEET_SUMMARY_TAB = "asana_writers_summary"
-SA_PATH = "service_account.json"
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ASSISTANT_ID   = os.getenv("OPENAI_ASSISTANT_ID")  # pre-created Assistant
 
 PROMPT_PATH = os.getenv("PROMPT_PATH", "prompt.txt")
 RULES_JSON_PATH = os.getenv("RULES_JSON_PATH", "rules.json")
-INCLUDE_HUB_PARENTS = os.getenv("INCLUDE_HUB_PARENTS", "false").lower() == "true"
+UPLOAD_NOTES_MAX_CHARS = int(os.getenv("UPLOAD_NOTES_MAX_CHARS", "500"))
+
+logger = logging.getLogger(__name__)
 
-def latest_jsonl(pattern="data/asana_writer_tasks_*.jsonl"):
+def latest_jsonl(data_dir="data", prefix="asana_writer_tasks_", suffix=".jsonl"):
     override = os.getenv("ANALYZE_JSONL_PATH")
     if override:
         if not os.path.exists(override):
             raise SystemExit(f"ANALYZE_JSONL_PATH not found: {override}")
         return override
-    import glob
-    files = sorted(glob.glob(pattern))
-    if not files:
+    # One scandir pass, newest by mtime; DirEntry.stat() reuses the listing
+    # where the OS allows, and nothing is collected or sorted.
+    latest = None
+    if os.path.isdir(data_dir):
+        with os.scandir(data_dir) as it:
+            latest = max(
+                (e for e in it if e.name.startswith(prefix) and e.name.endswith(suffix)),
+                key=lambda e: e.stat().st_mtime,
+                default=None,
+            )
+    if latest is None:
         raise SystemExit("No JSONL files found (set ANALYZE_JSONL_PATH or place a file under data/).")
-    return files[-1]
+    return latest.path
+
+def project_task(obj: dict) -> dict:
+    """Trim an Asana task to the fields the analyze prompt uses (same key shape)."""
+    return {
+        "gid": obj.get("gid", ""),
+        "name": obj.get("name") or "",
+        "assignee": {"name": (obj.get("assignee") or {}).get("name") or ""},
+        "_assignee_friendly": obj.get("_assignee_friendly") or "",
+        "due_on": obj.get("due_on") or "",
+        "is_subtask": bool(obj.get("is_subtask")),
+        "parent": {"name": (obj.get("parent") or {}).get("name") or ""},
+        "projects": [{"name": p["name"]} for p in (obj.get("projects") or []) if p and p.get("name")],
+        "permalink_url": obj.get("permalink_url") or "",
+        "notes": (obj.get("notes") or "")[:UPLOAD_NOTES_MAX_CHARS],
+    }
 
 def jsonl_to_json_file(jsonl_path: str) -> str:
     out_path = os.path.splitext(jsonl_path)[0] + "_upload.json"
-    objs = []
+    kept = 0
     skipped = 0
-    def is_hub_parent(name: str) -> bool:
-        # very light heuristic; we keep using LLM rules for final handling
-        # This only prunes obvious “container” rows to keep token size down.
-        name_low = (name or "").lower()
-        bars = "|" in (name or "")
-        has_runs_or_posted = (" runs " in name_low) or (" posted " in name_low)
-        return bars and has_runs_or_posted and not name_low.startswith(("writer:", "editor:", "ready", "published"))
-    with open(jsonl_path, "r", encoding="utf-8") as f:
+    # Stream each kept task straight into the output array; nothing is held
+    # in memory beyond the current line. Only the fields prompt.txt reads are
+    # kept, with notes truncated, to cut upload size and file_search tokens.
+    # (file_search does not index .jsonl, hence the array wrapper.)
+    with open(jsonl_path, "rb") as f, open(out_path, "wb") as w:
+        w.write(b"[")
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
-            obj = json.loads(line)
+            obj = orjson.loads(line)
             if not INCLUDE_HUB_PARENTS and is_hub_parent(obj.get("name", "")):
                 skipped += 1
                 continue
-            objs.append(obj)
-    with open(out_path, "w", encoding="utf-8") as w:
-        json.dump(objs, w, ensure_ascii=False)
-    print(f"Prepared upload JSON with {len(objs)} tasks (skipped {skipped} hub parents).")
+            if kept:
+                w.write(b",")
+            w.write(orjson.dumps(project_task(obj)))
+            kept += 1
+        w.write(b"]")
+    logger.info("Prepared upload JSON with %d tasks (skipped %d hub parents).", kept, skipped)
     return out_path
 
-def open_sheet(sheet_id: str, tab_name: str):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file(SA_PATH, scopes=scopes)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(sheet_id)
-    try:
-        ws = sh.worksheet(tab_name); ws.clear()
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab_name, rows="500", cols="10")
-    return ws
+@functools.lru_cache(maxsize=1)
+def _oai() -> OpenAI:
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY)
 
 def load_text(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+    # Keyed on mtime so a long-lived caller still sees edits to prompt/rules.
+    return _load_text_cached(path, os.path.getmtime(path))
+
+@functools.lru_cache(maxsize=8)
+def _load_text_cached(path: str, mtime: float) -> str:
+    return Path(path).read_text(encoding="utf-8")
 
 def main():
     if not (OPENAI_API_KEY and ASSISTANT_ID and SHEET_ID):
         raise SystemExit("Missing OPENAI_API_KEY, OPENAI_ASSISTANT_ID, or ASANA_GOOGLE_SHEET_ID.")
 
     jsonl_path = latest_jsonl()
-    print(f"Using file: {jsonl_path}")
+    logger.info("Using file: %s", jsonl_path)
     upload_path = jsonl_to_json_file(jsonl_path)
 
     prompt_text = load_text(PROMPT_PATH)
     rules_json  = load_text(RULES_JSON_PATH)
-    print(f"Attached rules from {os.path.abspath(RULES_JSON_PATH)}")
+    logger.debug("Attached rules from %s", os.path.abspath(RULES_JSON_PATH))
+
+    client = _oai()
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # Sheets auth has no dependency on the upload or the run; start it in the
+    # background so its handshakes overlap with the OpenAI calls. The tab
+    # itself is only cleared once there is a narrative to write.
+    pool = ThreadPoolExecutor(max_workers=1)
+    sh_future = pool.submit(open_spreadsheet, SHEET_ID)
+    pool.shutdown(wait=False)
 
     # Upload the compact JSON to the files API for Assistants
-    file_obj = client.files.create(file=open(upload_path, "rb"), purpose="assistants")
+    with open(upload_path, "rb") as fh:
+        file_obj = client.files.create(file=fh, purpose="assistants")
 
     # Kick off an Assistant run with your prompt
     thread = client.beta.threads.create()
@@ -97,34 +136,28 @@ def main():
         attachments=[{"file_id": file_obj.id, "tools": [{"type": "file_search"}]}],
     )
 
-    # Use your prompt text as the run instructions
-    run = client.beta.threads.runs.create(
+    # Stream the run with your prompt text as the instructions; each assistant
+    # message is collected as it completes, so there is no status polling or
+    # follow-up messages.list call. A file_search run can emit more than one
+    # message; their text blocks are joined with newlines as before.
+    parts = []
+    with client.beta.threads.runs.stream(
         thread_id=thread.id,
         assistant_id=ASSISTANT_ID,
-        instructions=prompt_text
-    )
-
-    # Poll to completion
-    while True:
-        r = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-        if r.status in ("completed", "failed", "cancelled", "expired"):
-            break
-        time.sleep(1.2)
+        instructions=prompt_text,
+    ) as stream:
+        for event in stream:
+            if event.event == "thread.message.completed":
+                parts.extend(c.text.value for c in event.data.content
+                             if c.type == "text" and c.text and c.text.value)
+        r = stream.get_final_run()
 
     if r.status != "completed":
         raise SystemExit(f"Run status={r.status}")
 
-    # Collect the assistant message text
-    msgs = client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=10)
-    parts = []
-    for m in msgs.data:
-        if m.role == "assistant":
-            for c in m.content:
-                if c.type == "text" and c.text and c.text.value:
-                    parts.append(c.text.value)
-    if not parts:
+    full_text = "\n".join(parts).strip()
+    if not full_text:
         raise SystemExit("Assistant returned no text.")
-    full_text = "\n".join(reversed(parts)).strip()
 
     # Save and write to Sheet
     stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
@@ -132,11 +165,14 @@ def main():
     with open(out_txt, "w", encoding="utf-8") as f:
         f.write(full_text)
 
-    ws = open_sheet(SHEET_ID, SHEET_SUMMARY_TAB)
-    ws.append_row(["Narrative"])
-    ws.append_row([full_text])
-    print("Wrote narrative to sheet tab:", SHEET_SUMMARY_TAB)
-    print("Saved narrative:", out_txt)
+    ws = open_tab(sh_future.result(), SHEET_SUMMARY_TAB, rows="500", cols="10")
+    ws.append_rows([["Narrative"], [full_text]], value_input_option="RAW")
+    logger.info("Wrote narrative to sheet tab: %s", SHEET_SUMMARY_TAB)
+    logger.debug("Saved narrative: %s", out_txt)
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s  %(message)s",
+    )
     main()
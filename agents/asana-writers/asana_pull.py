@@ -1,15 +1,17 @@
 import os
 import time
-import json
 import math
+import itertools
 import logging
+import threading
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any, Optional
+import orjson
 import requests
 from dotenv import load_dotenv
 
-import gspread
-from google.oauth2.service_account import Credentials
+from sheets_client import open_sheet
 
 # ------------- CONFIG -------------
 load_dotenv()
@@ -29,6 +31,9 @@ ASSIGNEE_GIDS: Dict[str, str] = {
     "Bethany Osborn": "1207757806946425",
 }
 
+GID_TO_NAME: Dict[str, str] = {gid: name for name, gid in ASSIGNEE_GIDS.items()}
+ALL_ASSIGNEE_GIDS = ",".join(ASSIGNEE_GIDS.values())
+
 OPT_FIELDS = ",".join([
     "name",
     "assignee.name",
@@ -43,6 +48,13 @@ OPT_FIELDS = ",".join([
     "is_subtask",
 ])
 
+# Column order for the sheet; format_rows emits rows in this order.
+SHEET_HEADER = (
+    "Task Name", "Assignee", "Due Date", "Completed",
+    "Project(s)", "Parent Task", "Task GID", "Task URL",
+    "Assignee GID", "Assignee (Friendly)",
+)
+
 PAGE_LIMIT = 100
 ASANA_BASE = "https://app.asana.com/api/1.0"
 HEADERS = {
@@ -50,6 +62,18 @@ HEADERS = {
     "Accept": "application/json",
 }
 
+# One keep-alive session per thread, so TCP + TLS is set up once per worker
+# rather than per request; requests.Session isn't documented as thread-safe,
+# and the parent/subtask searches run in separate pool threads.
+_local = threading.local()
+
+def get_session() -> requests.Session:
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+        session.headers.update(HEADERS)
+    return session
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s %(levelname)s  %(message)s",
@@ -68,30 +92,14 @@ def week_bounds(offset_weeks: int = 0, tz: dt.tzinfo = dt.timezone.utc) -> tuple
     return monday, sunday
 
 
-def daterange(start_date: dt.date, end_date: dt.date):
-    d = start_date
-    while d <= end_date:
-        yield d
-        d += dt.timedelta(days=1)
-
 # ------------- GOOGLE SHEETS -------------
-def open_sheet(sheet_id: str, tab_name: str):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file("service_account.json", scopes=scopes)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(sheet_id)
-    try:
-        ws = sh.worksheet(tab_name)
-        ws.clear()
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab_name, rows="100", cols="20")
-    return ws
+# open_sheet (shared, cached gspread session) lives in sheets_client
 
 # ------------- ASANA HTTP + PAGINATION -------------
 def fetch_with_retry(url: str, max_attempts: int = 5) -> requests.Response:
     backoff = 1.0
     for attempt in range(1, max_attempts + 1):
-        resp = requests.get(url, headers=HEADERS, timeout=60)
+        resp = get_session().get(url, timeout=60)
         if resp.status_code == 429 and attempt < max_attempts:
             retry_after = float(resp.headers.get("Retry-After", "2"))
             time.sleep(max(1.0, retry_after))
@@ -108,27 +116,37 @@ def build_url(path: str, params: Dict[str, Any]) -> str:
     q = {k: v for k, v in params.items() if v not in (None, "", [])}
     return f"{ASANA_BASE}{path}?{urlencode(q)}"
 
-def fetch_tasks_for_day(
-    day_iso: str,
+def fetch_tasks_due(
+    start: dt.date,
+    end: dt.date,
     assignee_any: Optional[str],
     is_subtask: Optional[bool],
-) -> List[Dict[str, Any]]:
+) -> tuple[List[Dict[str, Any]], bool]:
     """
     Call /workspaces/{workspace_gid}/tasks/search with:
-      - due_on = day_iso
-      - assignee.any = assignee_any (gid or 'me'), if provided
+      - due_on = start when start == end, else
+        due_on.after = start - 1 day, due_on.before = end + 1 day
+      - assignee.any = assignee_any (comma-separated gids or 'me'), if provided
       - is_subtask = true/false, if provided
       - limit = 100
       - opt_fields pre-defined
     Use next_page.uri if present, else fall back to offset.
+    Returns (tasks due in start..end, complete). complete is False when the
+    last page came back full with no next_page, i.e. search may have capped
+    the results.
     """
     params = {
-        "due_on": day_iso,
         "sort_by": "due_date",
         "sort_ascending": True,
         "limit": PAGE_LIMIT,
         "opt_fields": OPT_FIELDS,
     }
+    if start == end:
+        params["due_on"] = start.isoformat()
+    else:
+        # bounds are exclusive; widen by a day and re-check client-side below
+        params["due_on.after"] = (start - dt.timedelta(days=1)).isoformat()
+        params["due_on.before"] = (end + dt.timedelta(days=1)).isoformat()
     if assignee_any:
         params["assignee.any"] = assignee_any
     if is_subtask is not None:
@@ -137,6 +155,7 @@ def fetch_tasks_for_day(
     url = build_url(f"/workspaces/{ASANA_WORKSPACE_GID}/tasks/search", params)
     out: List[Dict[str, Any]] = []
     page = 0
+    complete = True
 
     while True:
         resp = fetch_with_retry(url)
@@ -147,11 +166,12 @@ def fetch_tasks_for_day(
         data = body.get("data", [])
         out.extend(data)
         page += 1
-        logging.info("Asana day %s subtask=%s page %d fetched %d (total %d)",
-                     day_iso, is_subtask, page, len(data), len(out))
+        logging.info("Asana %s..%s subtask=%s page %d fetched %d (total %d)",
+                     start, end, is_subtask, page, len(data), len(out))
 
         next_page = body.get("next_page")
         if not next_page:
+            complete = len(data) < PAGE_LIMIT
             break
         if next_page.get("uri"):
             url = next_page["uri"]
@@ -165,59 +185,74 @@ def fetch_tasks_for_day(
         # polite pacing
         time.sleep(0.1)
 
-    return out
+    lo, hi = start.isoformat(), end.isoformat()
+    return [t for t in out if lo <= (t.get("due_on") or "") <= hi], complete
+
+def fetch_tasks_in_range(
+    start: dt.date,
+    end: dt.date,
+    assignee_any: Optional[str],
+    is_subtask: Optional[bool],
+) -> List[Dict[str, Any]]:
+    """
+    One search for the whole range; halve it only if that search hit the
+    result cap. A single day that is still capped is re-run per assignee gid,
+    so the cap applies per writer per day.
+    """
+    tasks, complete = fetch_tasks_due(start, end, assignee_any, is_subtask)
+    if complete:
+        return tasks
+    if start == end:
+        gids = assignee_any.split(",") if assignee_any else []
+        if len(gids) > 1:
+            return [t for gid in gids for t in fetch_tasks_in_range(start, end, gid, is_subtask)]
+        logging.warning("Asana %s assignee=%s subtask=%s hit the %d-result search cap; results may be truncated",
+                        start, assignee_any, is_subtask, PAGE_LIMIT)
+        return tasks
+    mid = start + (end - start) // 2
+    return (fetch_tasks_in_range(start, mid, assignee_any, is_subtask)
+            + fetch_tasks_in_range(mid + dt.timedelta(days=1), end, assignee_any, is_subtask))
 
 # ------------- MAIN PULL -------------
 def pull_writer_tasks_next_week() -> List[Dict[str, Any]]:
     monday, sunday = week_bounds(0)
-    results: List[Dict[str, Any]] = []
-
-    for d in daterange(monday, sunday):
-        day_iso = d.isoformat()
-        for friendly_name, gid in ASSIGNEE_GIDS.items():
-            parents = fetch_tasks_for_day(day_iso, assignee_any=gid, is_subtask=False)
-            subs    = fetch_tasks_for_day(day_iso, assignee_any=gid, is_subtask=True)
 
-            # Merge + de-dupe by gid
-            by_gid: Dict[str, Dict[str, Any]] = {}
-            for t in [*parents, *subs]:
-                if t and t.get("gid"):
-                    by_gid[t["gid"]] = t
-
-            # annotate with our friendly assignee (helps when Asana name differs)
-            for t in by_gid.values():
-                if t.get("assignee") and t["assignee"].get("gid") == gid:
-                    t["_assignee_friendly"] = friendly_name
-                else:
-                    # still store for context
-                    t["_assignee_friendly"] = friendly_name
-
-            logging.info("Day %s · %s: parents %d, subs %d, merged %d",
-                         day_iso, friendly_name, len(parents), len(subs), len(by_gid))
-
-            results.extend(by_gid.values())
-
-    return results
+    # One search per subtask flag covers the whole week and every writer
+    # (comma-separated assignee.any); the two are independent, so run them
+    # side by side.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        parents_f = pool.submit(fetch_tasks_in_range, monday, sunday, ALL_ASSIGNEE_GIDS, False)
+        subs_f    = pool.submit(fetch_tasks_in_range, monday, sunday, ALL_ASSIGNEE_GIDS, True)
+        parents, subs = parents_f.result(), subs_f.result()
+
+    # Merge + de-dupe by gid in one pass, annotating each kept task with our
+    # friendly assignee (helps when Asana name differs)
+    by_gid: Dict[str, Dict[str, Any]] = {}
+    for t in itertools.chain(parents, subs):
+        gid = t.get("gid") if t else None
+        if gid and gid not in by_gid:
+            t["_assignee_friendly"] = GID_TO_NAME.get((t.get("assignee") or {}).get("gid"), "")
+            by_gid[gid] = t
+
+    logging.info("Week %s..%s: parents %d, subs %d, merged %d",
+                 monday, sunday, len(parents), len(subs), len(by_gid))
+
+    # keep the day-by-day ordering the sheet had with per-day queries
+    return sorted(by_gid.values(), key=lambda t: t.get("due_on") or "")
 
 # ------------- WRITE SHEET + JSONL -------------
 def write_to_sheet(rows: List[List[Any]]):
     ws = open_sheet(GOOGLE_SHEET_ID, SHEET_NAME)
-    header = [
-        "Task Name", "Assignee", "Due Date", "Completed",
-        "Project(s)", "Parent Task", "Task GID", "Task URL",
-        "Assignee GID", "Assignee (Friendly)"
-    ]
-    ws.append_row(header)
-
-    # gspread supports batch update via .append_rows
-    ws.append_rows(rows, value_input_option="RAW")
+    # header + rows go out in a single values.append request
+    ws.append_rows([list(SHEET_HEADER), *rows], value_input_option="RAW")
 
 def format_rows(tasks: List[Dict[str, Any]]) -> List[List[Any]]:
     out = []
     for t in tasks:
         name = (t.get("name") or "")
-        assignee_name = (t.get("assignee") or {}).get("name") or ""
-        assignee_gid  = (t.get("assignee") or {}).get("gid") or ""
+        assignee = t.get("assignee") or {}
+        assignee_name = assignee.get("name") or ""
+        assignee_gid  = assignee.get("gid") or ""
         due_on = t.get("due_on") or ""
         completed = bool(t.get("completed"))
         projects = ", ".join([p.get("name") for p in (t.get("projects") or []) if p and p.get("name")])
@@ -225,15 +260,16 @@ def format_rows(tasks: List[Dict[str, Any]]) -> List[List[Any]]:
         gid = t.get("gid") or ""
         url = t.get("permalink_url") or ""
         friendly = t.get("_assignee_friendly") or ""
+        # order must match SHEET_HEADER
         out.append([
             name, assignee_name, due_on, completed, projects, parent_name, gid, url, assignee_gid, friendly
         ])
     return out
 
 def save_jsonl(tasks: List[Dict[str, Any]], path: str):
-    with open(path, "w", encoding="utf-8") as f:
+    with open(path, "wb") as f:
         for t in tasks:
-            f.write(json.dumps(t, ensure_ascii=False) + "\n")
+            f.write(orjson.dumps(t) + b"\n")
     logging.info("Saved JSONL: %s", path)
 
 # ------------- CLI -------------
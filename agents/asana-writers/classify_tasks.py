@@ -1,165 +1,533 @@
-import os, json, time, datetime as dt
-from typing import List, Dict, Any
-from openai import OpenAI
+from __future__ import annotations
+import os, sys, gzip, math, time, random, asyncio, hashlib, sqlite3, threading, datetime as dt
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Dict, Any, Awaitable, Callable, Iterable, Iterator, Optional
+import orjson
+
+# Same hub/container heuristic (and INCLUDE_HUB_PARENTS override) as the analyze upload
+from hub_parents import INCLUDE_HUB_PARENTS, is_hub_parent
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI  # imported in main(); keeps module import cheap
 
 OUTPUT_DIR = "output"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CLASSIFIER_ID  = os.getenv("OPENAI_CLASSIFIER_ID") or os.getenv("OPENAI_ASSISTANT_ID")  # fallback
+CLASSIFY_MODEL = os.getenv("OPENAI_CLASSIFY_MODEL")  # defaults to the classifier Assistant's model
 
 JSONL_PATH     = os.getenv("ANALYZE_JSONL_PATH", "data/asana_writer_tasks_sample.jsonl")
 BATCH_SIZE     = int(os.getenv("CLASSIFY_BATCH_SIZE", "60"))          # safer than 80
 MIN_BATCH      = int(os.getenv("CLASSIFY_MIN_BATCH", "10"))
+# Batches are also closed once their estimated input + output tokens would
+# pass this budget; BATCH_SIZE stays the hard cap on tasks per reply.
+TOKEN_BUDGET   = int(os.getenv("CLASSIFY_TOKEN_BUDGET", "12000"))
+OUTPUT_TOKENS_PER_TASK = 100  # rough size of one classified record in the reply
 RUN_POLL_SECS  = int(os.getenv("CLASSIFY_RUN_TIMEOUT_SECS", "600"))
+CONCURRENCY    = int(os.getenv("CLASSIFY_CONCURRENCY", "8"))          # requests in flight
+# Account limits, used to pace requests before they are sent; 0 = unlimited.
+OPENAI_RPM     = int(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM     = int(os.getenv("OPENAI_TPM", "0"))
+# Fire a duplicate request if one has not answered within this many seconds
+# and keep whichever finishes first (set near the observed p95); 0 = off.
+HEDGE_AFTER_SECS = float(os.getenv("CLASSIFY_HEDGE_AFTER_SECS", "0"))
+# Attempts per request on 429 / connection / timeout / 5xx errors.
+MAX_ATTEMPTS   = int(os.getenv("CLASSIFY_MAX_ATTEMPTS", "5"))
 PROMPT_CLASSIFY_PATH = os.getenv("PROMPT_CLASSIFY_PATH", "prompt_classify.txt")
+RULES_JSON_PATH = os.getenv("RULES_JSON_PATH", "rules.json")
+# Strict structured output needs a model that supports json_schema. It is on
+# by default only when OPENAI_CLASSIFY_MODEL names the model explicitly; a
+# model inherited from the classifier Assistant is unchecked, so that path
+# defaults to plain JSON mode. CLASSIFY_JSON_SCHEMA=true/false overrides either way.
+CLASSIFY_JSON_SCHEMA = os.getenv("CLASSIFY_JSON_SCHEMA", "true" if CLASSIFY_MODEL else "false").lower() == "true"
+# "live" sends the batches concurrently and waits; "batch" submits them all as
+# one Batch API job (half price, but may take up to the 24h completion window).
+CLASSIFY_MODE  = os.getenv("CLASSIFY_MODE", "live").lower()
+# Batch job status is polled with backoff from 10s up to this cap.
+BATCH_POLL_SECS = int(os.getenv("CLASSIFY_BATCH_POLL_SECS", "300"))
+# Results from earlier runs, keyed by task content + model + prompt, so tasks
+# that haven't changed since are not sent again. CLASSIFY_CACHE=false skips it.
+CLASSIFY_CACHE = os.getenv("CLASSIFY_CACHE", "true").lower() == "true"
+CACHE_PATH     = os.getenv("CLASSIFY_CACHE_PATH", os.path.join(OUTPUT_DIR, ".classify_cache.sqlite"))
+# Compact output by default; set AUDIT_PRETTY=true for an indented file to read by hand
+AUDIT_JSON_OPTS = orjson.OPT_INDENT_2 if os.getenv("AUDIT_PRETTY", "false").lower() == "true" else 0
+
+if not OPENAI_API_KEY or not (CLASSIFY_MODEL or CLASSIFIER_ID):
+    raise SystemExit("Missing OPENAI_API_KEY, or both OPENAI_CLASSIFY_MODEL and OPENAI_CLASSIFIER_ID (or OPENAI_ASSISTANT_ID).")
+
+# Raw model replies go to one gzipped JSONL per day rather than a .txt per
+# batch; `zcat output/debug_*.jsonl.gz` reads them back.
+DEBUG_LOG = os.path.join(OUTPUT_DIR, f"debug_{dt.date.today().isoformat()}.jsonl.gz")
+_debug_log_lock = threading.Lock()  # log_blob runs in worker threads
+
+def log_blob(kind: str, tag: str, content: str) -> None:
+    # Each call appends its own gzip member; readers see one continuous stream.
+    # The lock keeps one member's header/body/trailer writes from interleaving
+    # with another thread's.
+    with _debug_log_lock, gzip.open(DEBUG_LOG, "ab") as f:
+        f.write(orjson.dumps({
+            "ts": dt.datetime.utcnow().isoformat(timespec="seconds"),
+            "kind": kind,
+            "tag": tag,
+            "content": content,
+        }) + b"\n")
+
+class RateLimiter:
+    """
+    Request and token buckets that refill continuously over a minute (the
+    api_request_parallel_processor pattern). acquire() waits until both
+    have room, so bursts are spread out up front instead of coming back
+    as 429s. A capacity of 0 disables that bucket.
+    """
+    def __init__(self, req_capacity: int, tok_capacity: int):
+        self.req_capacity = req_capacity
+        self.tok_capacity = tok_capacity
+        self.req_avail = float(req_capacity)
+        self.tok_avail = float(tok_capacity)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()  # waiters are served in arrival order
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        self.req_avail = min(self.req_capacity, self.req_avail + elapsed * self.req_capacity / 60)
+        self.tok_avail = min(self.tok_capacity, self.tok_avail + elapsed * self.tok_capacity / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.tok_capacity)  # a single oversized call must still get through
+        async with self.lock:
+            while True:
+                self._refill()
+                req_short = (1 - self.req_avail) if self.req_capacity else 0
+                tok_short = (tokens - self.tok_avail) if self.tok_capacity else 0
+                if req_short <= 0 and tok_short <= 0:
+                    break
+                await asyncio.sleep(max(
+                    req_short * 60 / self.req_capacity if req_short > 0 else 0,
+                    tok_short * 60 / self.tok_capacity if tok_short > 0 else 0,
+                ))
+            if self.req_capacity:
+                self.req_avail -= 1
+            if self.tok_capacity:
+                self.tok_avail -= tokens
+
+async def hedged(
+    coro_factory: Callable[[], Awaitable[Any]],
+    hedge_after: float = HEDGE_AFTER_SECS,
+) -> Any:
+    """
+    Await coro_factory(); if it is still running after `hedge_after` seconds,
+    start a second identical call and return the first successful result,
+    cancelling the other. Only for idempotent calls.
+    """
+    if hedge_after <= 0:
+        return await coro_factory()
+    first = asyncio.ensure_future(coro_factory())
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+    pending = {first, asyncio.ensure_future(coro_factory())}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None]
+            if ok:
+                return ok[0].result()
+            if not pending:
+                return done.pop().result()  # both failed: raise the error
+    finally:
+        for t in pending:
+            t.cancel()
 
-if not OPENAI_API_KEY or not CLASSIFIER_ID:
-    raise SystemExit("Missing OPENAI_API_KEY or OPENAI_CLASSIFIER_ID (or OPENAI_ASSISTANT_ID).")
+def retry_after_secs(value: Optional[str]) -> float:
+    """Retry-After as seconds; 0 (use the jittered delay) if missing or not a number, e.g. an HTTP-date."""
+    try:
+        secs = float(value or 0)
+    except ValueError:
+        return 0.0
+    return secs if math.isfinite(secs) and secs > 0 else 0.0
+
+async def create_with_retry(
+    client: AsyncOpenAI,
+    limiter: RateLimiter,
+    tokens: int,
+    **kwargs: Any,
+) -> Any:
+    """
+    chat.completions.create, retried with full-jitter exponential backoff
+    (capped at 60s, or the server's Retry-After) on transient errors. Each
+    attempt is a real request, so each one goes through the limiter. A bad
+    reply is not an error here; run_classify_batch handles that by gid.
+    """
+    from openai import APIConnectionError, InternalServerError, RateLimitError  # APITimeoutError is an APIConnectionError
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.acquire(tokens)
+        try:
+            # SDK retries off: this loop is the one retry layer, and it is paced
+            return await client.with_options(max_retries=0).chat.completions.create(**kwargs)
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(60.0, 2.0 ** attempt))
+            if isinstance(e, RateLimitError):
+                delay = max(delay, retry_after_secs(e.response.headers.get("retry-after")))
+            print(f"{type(e).__name__} (attempt {attempt}/{MAX_ATTEMPTS}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def estimate_tokens(messages: List[Dict[str, str]], n_tasks: int) -> int:
+    # TPM counts the expected completion as well as the prompt: ~4 characters
+    # per prompt token plus one classified record per task. Close enough for pacing.
+    return sum(len(m["content"]) for m in messages) // 4 + n_tasks * OUTPUT_TOKENS_PER_TASK
+
+def pack_until_token_budget(
+    tasks: Iterable[Dict[str, Any]],
+    budget: int = TOKEN_BUDGET,
+    max_items: int = BATCH_SIZE,
+) -> Iterator[List[Dict[str, Any]]]:
+    """Greedily fill each batch until the next task would pass the token budget."""
+    cur: List[Dict[str, Any]] = []
+    tok = 0
+    for task in tasks:
+        t = len(orjson.dumps(task)) // 4 + OUTPUT_TOKENS_PER_TASK
+        if cur and (tok + t > budget or len(cur) >= max_items):
+            yield cur
+            cur, tok = [], 0
+        cur.append(task)
+        tok += t
+    if cur:
+        yield cur
+
+def open_cache(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS c(k TEXT PRIMARY KEY, v BLOB)")
+    return conn
+
+def cache_key(salt: bytes, task: Dict[str, Any]) -> str:
+    # salt covers model, prompt/rules and response_format, so changing any of them invalidates old entries
+    return hashlib.blake2b(salt + orjson.dumps(task, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
 
 def load_text(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+    return Path(path).read_text(encoding="utf-8")
 
-def load_tasks(jsonl_path: str) -> List[Dict[str, Any]]:
-    tasks: List[Dict[str, Any]] = []
-    with open(jsonl_path, "r", encoding="utf-8") as f:
+def iter_tasks(jsonl_path: str) -> Iterator[Dict[str, Any]]:
+    """Yield each task projected to the 6 classifier fields; the full Asana object is dropped per line."""
+    # Key literals are already shared constants. Assignee/parent names and due
+    # dates repeat across many rows (a handful of writers, one week of dates),
+    # so intern them: one string object each instead of one per row.
+    intern = sys.intern
+    with open(jsonl_path, "rb") as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
-            obj = json.loads(line)
-            tasks.append({
+            obj = orjson.loads(line)
+            yield {
                 "gid": obj.get("gid", ""),
                 "name": obj.get("name", "") or "",
-                "parent_name": (obj.get("parent") or {}).get("name") or "",
-                "assignee_name": (obj.get("assignee") or {}).get("name") or "",
-                "due_on": obj.get("due_on") or "",
-            })
-    return tasks
+                "parent_name": intern((obj.get("parent") or {}).get("name") or ""),
+                "assignee_name": intern((obj.get("assignee") or {}).get("name") or ""),
+                "due_on": intern(obj.get("due_on") or ""),
+                "url": obj.get("permalink_url") or "",
+            }
 
 def make_batch_prompt(batch: List[Dict[str, Any]]) -> str:
     # Embed the batch as JSON inside the user message (no tool attachments).
-    return json.dumps({"input": batch}, ensure_ascii=False)
-
-def poll_until_done(client: OpenAI, thread_id: str, run_id: str, timeout_s: int = RUN_POLL_SECS):
-    start = time.time()
-    while True:
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        if run.status in ("completed", "failed", "cancelled", "expired"):
-            return run
-        if time.time() - start > timeout_s:
-            return run  # caller will handle non-completed status
-        time.sleep(1.2)
-
-def run_classify_batch(
-    client: OpenAI,
-    assistant_id: str,
+    # orjson emits UTF-8 as-is (like ensure_ascii=False) and without spaces.
+    return orjson.dumps({"input": batch}).decode("utf-8")
+
+NOTE_TEMPLATE = (
+    "\n\nHARD REQUIREMENT: Return a JSON object with a 'tasks' array "
+    "of exactly {n} items — one for each input — in the same order. "
+    "No commentary, no extra fields."
+)
+
+def batch_note(n: int) -> str:
+    return NOTE_TEMPLATE.format(n=n)
+
+def parse_tasks_reply(raw: str) -> Optional[List[Dict[str, Any]]]:
+    """Return the reply's 'tasks' list, or None if it isn't that shape."""
+    try:
+        obj = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(obj, dict) and isinstance(obj.get("tasks"), list):
+        return obj["tasks"]
+    return None
+
+def match_by_gid(
+    batch: List[Dict[str, Any]],
+    results: List[Dict[str, Any]],
+) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split a reply into (results for gids in the batch, batch tasks with no result)."""
+    wanted = {t["gid"] for t in batch}
+    done = [r for r in results if isinstance(r, dict) and r.get("gid") in wanted]
+    got = {r["gid"] for r in done}
+    return done, [t for t in batch if t["gid"] not in got]
+
+CATEGORIES = ["Drafting", "Editing", "Publishing", "Planning", "Other"]
+
+def response_format(ad_types: List[str]) -> Dict[str, Any]:
+    """json_schema for the classifier reply, with ad_type limited to rules.json."""
+    if not CLASSIFY_JSON_SCHEMA:
+        return {"type": "json_object"}
+    task = {
+        "type": "object",
+        "properties": {
+            "gid": {"type": "string"},
+            "name": {"type": "string"},
+            "assignee_name": {"type": "string"},
+            "due_on": {"type": "string"},
+            "parent_name": {"type": "string"},
+            "url": {"type": "string"},
+            "category": {"type": "string", "enum": CATEGORIES},
+            "ad_type": {"type": "string", "enum": ad_types},
+            "effort_minutes": {"type": "integer"},
+            "explain": {"type": "string"},
+        },
+        "additionalProperties": False,
+    }
+    task["required"] = list(task["properties"])
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "classified_tasks",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"tasks": {"type": "array", "items": task}},
+                "required": ["tasks"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def classify_messages(batch: List[Dict[str, Any]], prompt_base: str) -> List[Dict[str, str]]:
+    # The system message is byte-identical for every batch so the provider's
+    # prompt cache serves the rubric + rules prefix; only the user turn varies.
+    return [
+        {"role": "system", "content": prompt_base},
+        {"role": "user", "content": make_batch_prompt(batch) + batch_note(len(batch))},
+    ]
+
+async def run_classify_batch(
+    client: AsyncOpenAI,
+    base: Dict[str, Any],   # model + response_format shared by every request
     batch: List[Dict[str, Any]],
     tag: str,
     prompt_base: str,   # <-- pass the prompt in
+    sem: asyncio.Semaphore,
+    limiter: RateLimiter,
 ) -> List[Dict[str, Any]]:
     """
-    Runs one batch through the Assistant. If the JSON is short/invalid,
-    we recursively split the batch until <= MIN_BATCH or it succeeds.
+    Classifies one batch with a single structured-output chat completion. Tasks the
+    reply misses are re-requested on their own; if the JSON is invalid we
+    recursively split the batch until <= MIN_BATCH or it succeeds. `sem`
+    bounds how many requests are in flight at once; `limiter` paces them
+    to the account's RPM/TPM.
     """
-    # 1) Create a thread and post the input JSON in the user message
-    thread = client.beta.threads.create()
-    client.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content=make_batch_prompt(batch)
+    # 1) One request: fixed rubric as system, batch JSON + per-batch constraint as user
+    messages = classify_messages(batch, prompt_base)
+    tokens = estimate_tokens(messages, len(batch))
+
+    async def request():
+        # a hedge is a real request and is paced/retried the same way
+        return await create_with_retry(
+            client, limiter, tokens,
+            **base,
+            messages=messages,
+            timeout=RUN_POLL_SECS,
+        )
+
+    async with sem:
+        resp = await hedged(request)
+
+    # 2) Save raw for debugging
+    raw_concat = (resp.choices[0].message.content or "").strip() if resp.choices else ""
+    # Compress + append off the event loop so other batches keep moving
+    await asyncio.to_thread(log_blob, "classify_batch", tag, raw_concat)
+
+    # 3) Parse once, then map results back to the inputs by gid
+    done, missing = match_by_gid(batch, parse_tasks_reply(raw_concat) or [])
+    if not missing or len(batch) <= MIN_BATCH:
+        return done  # complete, or best-effort salvage at MIN_BATCH
+
+    # Partial reply: re-ask only for what's missing. Nothing usable: split.
+    if done:
+        return done + await run_classify_batch(client, base, missing, tag + "_M", prompt_base, sem, limiter)
+    mid = len(batch) // 2
+    left, right = await asyncio.gather(
+        run_classify_batch(client, base, batch[:mid], tag + "_L", prompt_base, sem, limiter),
+        run_classify_batch(client, base, batch[mid:], tag + "_R", prompt_base, sem, limiter),
     )
+    return left + right
+
+async def run_batch_job(
+    client: AsyncOpenAI,
+    batches: List[List[Dict[str, Any]]],
+    prompt_base: str,
+    base: Dict[str, Any],
+) -> Dict[str, str]:
+    """
+    Submits every batch as one Batch API job against /v1/chat/completions
+    and returns the raw reply text keyed by batch tag. Batches that errored
+    are simply absent; the caller re-runs those as live requests.
+    """
+    stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
+    req_path = os.path.join(OUTPUT_DIR, f"classify_batch_requests_{stamp}.jsonl")
+    with open(req_path, "wb") as f:
+        for i, batch in enumerate(batches, 1):
+            f.write(orjson.dumps({
+                "custom_id": f"{i:02d}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {**base, "messages": classify_messages(batch, prompt_base)},
+            }) + b"\n")
 
-    # 2) Run with strict, per-batch constraint
-    per_batch_note = (
-        f"\n\nHARD REQUIREMENT: Return a JSON object with a 'tasks' array "
-        f"of exactly {len(batch)} items — one for each input — in the same order. "
-        "No commentary, no extra fields."
+    with open(req_path, "rb") as fh:
+        input_file = await client.files.create(file=fh, purpose="batch")
+    job = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
     )
+    print(f"Submitted batch job {job.id} ({len(batches)} requests)")
+    delay = 10.0  # small jobs often finish in minutes; long ones are polled rarely
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, BATCH_POLL_SECS)
+        job = await client.batches.retrieve(job.id)
+    print(f"Batch job {job.id}: status={job.status}")
+    if not job.output_file_id:
+        return {}
 
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant_id,
-        instructions=prompt_base + per_batch_note
+    raw = (await client.files.content(job.output_file_id)).content
+    with open(os.path.join(OUTPUT_DIR, f"classify_batch_output_{stamp}.jsonl"), "wb") as f:
+        f.write(raw)
+
+    replies: Dict[str, str] = {}
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        rec = orjson.loads(line)
+        choices = (((rec.get("response") or {}).get("body") or {}).get("choices")) or []
+        if choices:
+            replies[rec["custom_id"]] = (choices[0].get("message") or {}).get("content") or ""
+    return replies
+
+async def classify_all(client: AsyncOpenAI) -> None:
+    # The rubric plus rules.json (authoritative for ad types and effort) make up
+    # the system prompt; the assistant used to get rules.json via file_search.
+    rules_text = load_text(RULES_JSON_PATH)
+    prompt_base = (
+        load_text(PROMPT_CLASSIFY_PATH)  # single source of truth for the rubric
+        + "\n\nRULES JSON (authoritative for ad type & effort):\n" + rules_text
     )
-    run = poll_until_done(client, thread.id, run.id)
-
-    # 3) Collect text and save raw for debugging
-    raw_texts: List[str] = []
-    msgs = client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=10)
-    for m in msgs.data:
-        if m.role == "assistant":
-            for c in m.content:
-                if c.type == "text" and getattr(c, "text", None) and getattr(c.text, "value", None):
-                    raw_texts.append(c.text.value)
-    raw_texts.reverse()
-    raw_concat = "\n".join(raw_texts).strip()
+    ad_types = [r["ad_type"] for r in orjson.loads(rules_text)]
+    model = CLASSIFY_MODEL or (await client.beta.assistants.retrieve(CLASSIFIER_ID)).model
+    base = {"model": model, "response_format": response_format(ad_types)}
 
-    stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
-    raw_path = os.path.join(OUTPUT_DIR, f"classify_batch_{tag}_{stamp}.txt")
-    with open(raw_path, "w", encoding="utf-8") as f:
-        f.write(raw_concat)
+    # Hub parents are dropped up front: prompt_classify.txt tells the model to
+    # leave them out of its reply, so sending them would only yield a _M
+    # top-up and a cache miss on every run. Cache hits are set aside; only the
+    # misses are packed into batches.
+    conn = open_cache(CACHE_PATH) if CLASSIFY_CACHE else None
+    # Replies are only reusable under the same model, prompt and output mode:
+    # json_object replies were never schema-validated and must not be served
+    # once strict json_schema is back on.
+    salt = hashlib.blake2b(
+        f"{model}\0{prompt_base}\0".encode("utf-8") + orjson.dumps(base["response_format"])
+    ).digest()
+    cached: List[Dict[str, Any]] = []
+    keys: Dict[str, str] = {}  # gid -> cache key, for the tasks actually sent
+    hubs = 0
 
-    # 4) Try parse + validate count
-    try:
-        obj = json.loads(raw_concat)
-        out = obj.get("tasks", [])
-        if isinstance(out, list) and len(out) == len(batch):
-            return out
-    except Exception:
-        pass
-
-    # If here, not a full valid set. Split unless at MIN_BATCH; then salvage best-effort.
-    if len(batch) > MIN_BATCH:
-        mid = len(batch) // 2
-        left  = run_classify_batch(client, assistant_id, batch[:mid],  tag + "_L", prompt_base)
-        right = run_classify_batch(client, assistant_id, batch[mid:], tag + "_R", prompt_base)
-        return left + right
-    else:
-        try:
-            obj = json.loads(raw_concat)
-            out = obj.get("tasks", [])
-            if isinstance(out, list):
-                return out
-        except Exception:
-            return []
-        return []
-
-def main():
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    tasks = load_tasks(JSONL_PATH)
-    total = len(tasks)
-
-    prompt_base = load_text(PROMPT_CLASSIFY_PATH)  # single source of truth for the rubric
-    print(f"Classifying {total} tasks in batch(es) of up to {BATCH_SIZE}…")
-
-    results: List[Dict[str, Any]] = []
-    batches = [tasks[i:i + BATCH_SIZE] for i in range(0, total, BATCH_SIZE)]
-    for i, batch in enumerate(batches, 1):
+    def uncached(tasks: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        nonlocal hubs
+        for task in tasks:
+            if not INCLUDE_HUB_PARENTS and is_hub_parent(task["name"]):
+                hubs += 1
+                continue
+            if conn is not None:
+                k = cache_key(salt, task)
+                row = conn.execute("SELECT v FROM c WHERE k=?", (k,)).fetchone()
+                if row:
+                    cached.append(orjson.loads(row[0]))
+                    continue
+                keys[task["gid"]] = k
+            yield task
+
+    batches = list(pack_until_token_budget(uncached(iter_tasks(JSONL_PATH))))
+    total = len(cached) + sum(map(len, batches))
+    print(f"Classifying {total - len(cached)} of {total} tasks ({len(cached)} cached, "
+          f"{hubs} hub parents skipped) "
+          f"in {len(batches)} batch(es) (≤{BATCH_SIZE} tasks / ~{TOKEN_BUDGET} tokens each)…")
+
+    replies: Dict[str, str] = {}
+    if CLASSIFY_MODE == "batch" and batches:
+        replies = await run_batch_job(client, batches, prompt_base, base)
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+    async def classify(i: int, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         tag = f"{i:02d}"
-        out = run_classify_batch(client, CLASSIFIER_ID, batch, tag, prompt_base)
+        if tag not in replies:
+            out = await run_classify_batch(client, base, batch, tag, prompt_base, sem, limiter)
+        else:
+            # batch-job reply: top up anything it missed with a live request
+            out, missing = match_by_gid(batch, parse_tasks_reply(replies[tag]) or [])
+            if missing:
+                out += await run_classify_batch(client, base, missing, tag + "_M", prompt_base, sem, limiter)
         print(f"Batch {i}: received {len(out)} classified items")
-        results.extend(out)
+        return out
+
+    # All batches in flight at once (bounded by sem); gather keeps input order.
+    outs = await asyncio.gather(*(classify(i, b) for i, b in enumerate(batches, 1)))
 
-    # Merge by gid (dedupe)
-    by_gid: Dict[str, Dict[str, Any]] = {}
-    for r in results:
-        gid = r.get("gid")
-        if gid:
-            by_gid[gid] = r
+    # Merge by gid in one pass; on a duplicate gid the later result wins
+    by_gid: Dict[str, Dict[str, Any]] = {
+        r["gid"]: r for out in (cached, *outs) for r in out if r.get("gid")
+    }
+
+    if conn is not None:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO c(k, v) VALUES (?, ?)",
+                [(keys[g], orjson.dumps(by_gid[g])) for g in keys if g in by_gid],
+            )
+        conn.close()
 
     # Persist final JSON
     stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
     out_path = os.path.join(OUTPUT_DIR, f"classified_tasks_{stamp}.json")
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump({"tasks": list(by_gid.values())}, f, ensure_ascii=False, indent=2)
+    # Write to a temp file and rename it into place, so summarize_workload
+    # (which picks the newest classified_tasks_*.json) never sees a partial file.
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(
+            {"tasks": list(by_gid.values())},
+            option=AUDIT_JSON_OPTS | orjson.OPT_APPEND_NEWLINE,
+        ))
+    os.replace(tmp_path, out_path)
 
     print("----- Classification summary -----")
     print("Input tasks:   ", total)
-    print("Classified:    ", len(by_gid))
+    print("Classified:    ", len(by_gid), f"({len(cached)} from cache)")
     print("Output JSON:   ", out_path)
-    print("Raw logs saved under:", OUTPUT_DIR)
+    print("Raw log:       ", DEBUG_LOG)
+
+async def main():
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    # One client (one httpx pool) for every request, sized so each in-flight
+    # request keeps a warm connection instead of paying a fresh TLS handshake.
+    # Closing it on the way out drains the keep-alive connections too.
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=CONCURRENCY * 2, max_keepalive_connections=CONCURRENCY),
+        timeout=httpx.Timeout(RUN_POLL_SECS, connect=10.0),
+    )
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client) as client:
+        await classify_all(client)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
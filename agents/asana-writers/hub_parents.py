@@ -0,0 +1,21 @@
+import os
+import re
+
+# Shared “hub/container parent” heuristic for the analyze upload and the
+# classifier batches; INCLUDE_HUB_PARENTS=true keeps those rows in both.
+INCLUDE_HUB_PARENTS = os.getenv("INCLUDE_HUB_PARENTS", "false").lower() == "true"
+
+# Compiled once; case-insensitive so names never need lowercasing per row.
+HUB_MARKER_RE = re.compile(r" (?:runs|posted) ", re.IGNORECASE)
+ACTIONABLE_PREFIX_RE = re.compile(r"writer:|editor:|ready|published", re.IGNORECASE)
+
+def is_hub_parent(name: str) -> bool:
+    # very light heuristic; we keep using LLM rules for final handling
+    # This only prunes obvious “container” rows to keep token size down.
+    # Cheapest test first: most names have no bar, so no regex runs at all.
+    return bool(
+        name
+        and "|" in name
+        and HUB_MARKER_RE.search(name)
+        and not ACTIONABLE_PREFIX_RE.match(name)
+    )
@@ -0,0 +1,30 @@
+import functools
+
+# Shared Google Sheets access for the asana-writers scripts: one
+# service-account parse + authorized gspread session per process.
+SA_PATH = "service_account.json"
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+@functools.lru_cache(maxsize=1)
+def get_gc():
+    # imported here: gspread/google-auth are heavy and only needed once a sheet is touched
+    import gspread
+    from google.oauth2.service_account import Credentials
+    creds = Credentials.from_service_account_file(SA_PATH, scopes=SCOPES)
+    return gspread.authorize(creds)
+
+def open_spreadsheet(sheet_id: str):
+    return get_gc().open_by_key(sheet_id)
+
+def open_tab(sh, tab_name: str, rows: str = "100", cols: str = "20"):
+    """Return tab_name cleared, creating it (rows x cols) if missing."""
+    import gspread
+    try:
+        ws = sh.worksheet(tab_name)
+        ws.clear()
+    except gspread.WorksheetNotFound:
+        ws = sh.add_worksheet(title=tab_name, rows=rows, cols=cols)
+    return ws
+
+def open_sheet(sheet_id: str, tab_name: str, rows: str = "100", cols: str = "20"):
+    return open_tab(open_spreadsheet(sheet_id), tab_name, rows=rows, cols=cols)
@@ -1,59 +1,53 @@
-import os, json, time, datetime as dt, glob
-from typing import Any, Dict
-from openai import OpenAI
-import gspread
-from google.oauth2.service_account import Credentials
+import os, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sheets_client import open_spreadsheet, open_tab
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SUMMARIZER_ID  = os.getenv("OPENAI_SUMMARIZER_ID")
 SHEET_ID       = os.getenv("ASANA_GOOGLE_SHEET_ID")
-SA_PATH        = "service_account.json"
 SUMMARY_TAB    = "asana_writers_summary"
 OUTPUT_DIR     = "output"
 
 CAPACITY_JSON = os.getenv("CAPACITY_JSON", "")  # optional: {"Name": minutes, ...}
 
-def open_sheet(sheet_id: str, tab_name: str):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = Credentials.from_service_account_file(SA_PATH, scopes=scopes)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(sheet_id)
-    try:
-        ws = sh.worksheet(tab_name); ws.clear()
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab_name, rows="200", cols="20")
-    return ws
-
 def find_latest_classified() -> str:
-    candidates = sorted(glob.glob(f"{OUTPUT_DIR}/classified_tasks_*.json"))
-    if not candidates:
+    # One scandir pass, newest by mtime; no glob list or sort.
+    latest = None
+    if os.path.isdir(OUTPUT_DIR):
+        with os.scandir(OUTPUT_DIR) as it:
+            latest = max(
+                (e for e in it if e.name.startswith("classified_tasks_") and e.name.endswith(".json")),
+                key=lambda e: e.stat().st_mtime,
+                default=None,
+            )
+    if latest is None:
         raise SystemExit("No classified_tasks_*.json found. Run classify_tasks.py first.")
-    return candidates[-1]
-
-def poll_until_complete(client: OpenAI, thread_id: str, run_id: str, timeout_s=600):
-    t0 = time.time()
-    while True:
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        if run.status in ("completed", "failed", "cancelled", "expired"):
-            return run
-        if time.time() - t0 > timeout_s:
-            raise TimeoutError("Assistant run timed out")
-        time.sleep(1.2)
+    return latest.path
 
 def main():
     if not (OPENAI_API_KEY and SUMMARIZER_ID and SHEET_ID):
         raise SystemExit("Missing OPENAI_API_KEY, OPENAI_SUMMARIZER_ID or ASANA_GOOGLE_SHEET_ID")
 
+    from openai import OpenAI
     client = OpenAI(api_key=OPENAI_API_KEY)
 
+    # Sheets auth doesn't depend on the summary; run it alongside the upload
+    # and the run. The tab is only cleared once there is text to write.
+    pool = ThreadPoolExecutor(max_workers=1)
+    sh_future = pool.submit(open_spreadsheet, SHEET_ID)
+    pool.shutdown(wait=False)
+
     classified_path = find_latest_classified()
-    f_classified = client.files.create(file=open(classified_path, "rb"), purpose="assistants")
+    with open(classified_path, "rb") as fh:
+        f_classified = client.files.create(file=fh, purpose="assistants")
 
     extra_instr = ""
     if CAPACITY_JSON:
         extra_instr = f"Use this capacity map (minutes/week): {CAPACITY_JSON}"
 
-    prompt = open("prompt_summarize.txt", "r", encoding="utf-8").read()
+    prompt = Path("prompt_summarize.txt").read_text(encoding="utf-8")
 
     thread = client.beta.threads.create()
     client.beta.threads.messages.create(
@@ -62,17 +56,24 @@ def main():
         content="Summarize the attached classified tasks into a Slack message.",
         attachments=[{"file_id": f_classified.id, "tools": [{"type": "file_search"}]}],
     )
-    run = client.beta.threads.runs.create(
+    # Stream the run: each assistant message is collected as it completes, so
+    # there is no status polling and no follow-up messages.list round trip.
+    # Messages are joined with newlines so a multi-message run stays readable.
+    parts = []
+    with client.beta.threads.runs.stream(
         thread_id=thread.id,
         assistant_id=SUMMARIZER_ID,
         instructions=prompt + ("\n\n" + extra_instr if extra_instr else ""),
-    )
-    run = poll_until_complete(client, thread.id, run.id)
+    ) as stream:
+        for event in stream:
+            if event.event == "thread.message.completed":
+                parts.append("".join(c.text.value for c in event.data.content
+                                     if c.type == "text" and c.text))
+        run = stream.get_final_run()
     if run.status != "completed":
         raise SystemExit(f"Summarizer status={run.status}")
 
-    msgs = client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=1)
-    message_text = "".join(c.text.value for c in msgs.data[0].content if c.type == "text").strip()
+    message_text = "\n".join(p for p in parts if p).strip()
 
     # Save txt artifact
     stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
@@ -82,7 +83,7 @@ def main():
         f.write(message_text)
 
     # Write to sheet (cell A1)
-    ws = open_sheet(SHEET_ID, SUMMARY_TAB)
+    ws = open_tab(sh_future.result(), SUMMARY_TAB, rows="200", cols="20")
     ws.update("A1", [[message_text]])
     print(f"Wrote Slack message to sheet '{SUMMARY_TAB}' and saved {txt_path}")
 